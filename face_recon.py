@@ -1,11 +1,26 @@
 import face_recognition
+import dlib
 import cv2
 import numpy as np
 import os
-import pickle
+import json
 import random
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from scipy.spatial import distance as dist
+from math import sqrt
+
+try:
+    from numba import njit
+except ImportError:  # Matching falls back to the numpy GEMV path
+    njit = None
+
+try:
+    import hnswlib
+except ImportError:  # Matching always uses the exact linear scan
+    hnswlib = None
 
 # ====================================================================
 # 1. CONSTANTS AND STATE VARIABLES
@@ -19,12 +34,31 @@ challenge_confirmation_counter = 0
 CHALLENGE_GRACE_PERIOD = 0.5 # Seconds to wait before checking a challenge
 
 # --- Detection Thresholds ---
+MATCH_TOLERANCE = 0.50  # Max face distance for a positive match
+RECOGNITION_RETRY_INTERVAL = 0.5  # Seconds between re-matching attempts after a failed match
+ANN_MIN_FACES = 2000  # Use an approximate (HNSW) index once the database reaches this size
 HEAD_TURN_THRESHOLD = 0.3  # Relative nose movement
 SMILE_ABSOLUTE_THRESHOLD = 0.7   # Relative increase in mouth width
 
+# --- Face State Layout ---
+NOSE_IDX = 0   # Relative nose x position
+MOUTH_IDX = 1  # Relative mouth width
+
+# --- Frame Processing ---
+CAPTURE_WIDTH, CAPTURE_HEIGHT = 640, 480  # Requested webcam resolution (MJPG)
+DETECT_HEIGHT = 240  # Frames are downscaled by a whole factor to about this many rows
+
+# --- Tracking Settings ---
+DETECT_EVERY = 5  # Run the full face detector once every N frames, track in between
+DETECT_UPSAMPLE = 0  # Image pyramid upsamples for the webcam detector; safe at DETECT_HEIGHT
+
+# --- Enrollment ---
+ENROLL_BATCH_IMAGES = 32  # Images held in memory per batched encode on CUDA builds
+
 # --- File Paths ---
 PATH = 'student_images'
-ENCODINGS_FILE = 'encodings.pkl'
+ENCODINGS_FILE = 'encodings.npy'
+CLASS_NAMES_FILE = 'classNames.json'
 
 # --- State Management ---
 liveness_approved = False
@@ -32,193 +66,449 @@ challenge_sequence = []
 current_challenge_index = -1
 challenge_start_time = None
 initial_face_state = None
+challenge_check = None
+recognized_name = None
+next_recognition_time = 0.0
 students_marked_today = set()
+attendance_file = None
 
 # ====================================================================
 # 2. HELPER FUNCTIONS
 # ====================================================================
 
+def open_attendance_file():
+    """Opens today's attendance CSV for appending, writing the header if it is new."""
+    f = open(f'Attendance_{datetime.now().strftime("%Y-%m-%d")}.csv', 'a', newline='')
+    if f.tell() == 0:
+        f.write('Name,Time\n')
+        f.flush()
+    return f
+
 def mark_attendance(name):
-    """Writes the student's name and time to a daily CSV file."""
+    """Writes the student's name and time to the open daily CSV file."""
     global students_marked_today
     if name not in students_marked_today:
-        now = datetime.now()
-        date_string = now.strftime('%Y-%m-%d')
-        time_string = now.strftime('%H:%M:%S')
-        with open(f'Attendance_{date_string}.csv', 'a', newline='') as f:
-            if f.tell() == 0:
-                f.write('Name,Time\n')
-            f.write(f'{name},{time_string}\n')
+        time_string = datetime.now().strftime('%H:%M:%S')
+        attendance_file.write(f'{name},{time_string}\n')
+        attendance_file.flush()
         students_marked_today.add(name)
         print(f"Attendance marked for {name}")
 
+def quantize_int8(vectors):
+    """Quantizes rows to int8 with a per-row scale; returns (values, scales)."""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = 127.0 / np.maximum(np.abs(vectors).max(axis=1, keepdims=True), 1e-12)
+    return np.round(vectors * scales).astype(np.int8), scales.ravel().astype(np.float32)
+
+def load_student_images(student_path):
+    """Reads every image in one student's folder as RGB; returns (file names, images)."""
+    img_files, images = [], []
+    for img_file in os.listdir(student_path):
+        img = cv2.imread(os.path.join(student_path, img_file))
+        if img is None: continue
+        img_files.append(img_file)
+        images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    return img_files, images
+
+def locate_faces(images):
+    """Finds faces in each image, as one CNN batch on CUDA builds when all sizes match."""
+    if dlib.DLIB_USE_CUDA and images and len({img.shape for img in images}) == 1:
+        return face_recognition.batch_face_locations(images, batch_size=32)
+    return [face_recognition.face_locations(img) for img in images]
+
+def encode_faces(images, locations):
+    """Encodes the first face of each image in one dlib call; returns ((k, 128) array, found flags)."""
+    # Same 5-point alignment face_recognition.face_encodings uses, but all the
+    # chips go through the ResNet in a single batched compute_face_descriptor.
+    found = [bool(locs) for locs in locations]
+    batch_imgs, batch_faces = [], []
+    for img, locs in zip(images, locations):
+        if not locs: continue
+        top, right, bottom, left = locs[0]
+        shapes = dlib.full_object_detections()
+        shapes.append(face_recognition.api.pose_predictor_5_point(img, dlib.rectangle(left, top, right, bottom)))
+        batch_imgs.append(img)
+        batch_faces.append(shapes)
+    encodings = np.empty((len(batch_imgs), 128), dtype=np.float32)
+    if batch_imgs:
+        descriptors = face_recognition.api.face_encoder.compute_face_descriptor(batch_imgs, batch_faces, 1)
+        for row, image_descriptors in enumerate(descriptors):
+            encodings[row] = np.array(image_descriptors[0])
+    return encodings, found
+
+def encode_students(student_paths):
+    """Encodes several student folders as one batch; returns a list of (name, (k, 128) array)."""
+    students = [(os.path.basename(path), *load_student_images(path)) for path in student_paths]
+    images = [img for _, _, student_images in students for img in student_images]
+    encodings, found = encode_faces(images, locate_faces(images))
+
+    results = []
+    img_idx = row = 0
+    for student_name, img_files, _ in students:
+        start = row
+        for img_file in img_files:
+            if found[img_idx]:
+                row += 1
+            else:
+                print(f"Warning: No face found in {student_name}/{img_file}. Skipping.")
+            img_idx += 1
+        results.append((student_name, encodings[start:row]))
+    return results
+
+def encode_students_in_groups(student_paths):
+    """Encodes folders in groups of about ENROLL_BATCH_IMAGES images, bounding memory use."""
+    results = []
+    group, group_size = [], 0
+    for path in student_paths:
+        group.append(path)
+        group_size += len(os.listdir(path))
+        if group_size >= ENROLL_BATCH_IMAGES:
+            results.extend(encode_students(group))
+            group, group_size = [], 0
+    if group:
+        results.extend(encode_students(group))
+    return results
+
+def encode_student(student_path):
+    """Encodes every image in one student's folder; returns (name, (k, 128) array)."""
+    return encode_students([student_path])[0]
+
+def face_distances(encoding):
+    """Euclidean distance from one encoding to every known encoding."""
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, so the whole scan is one GEMV.
+    # This stays on the float32 database: numpy has no BLAS path for int8 and
+    # would widen the whole array on every call. The int8 copy is only read by
+    # the compiled kernel.
+    probe = np.asarray(encoding, dtype=np.float32)
+    sq_dists = known_sq_norms + probe.dot(probe) - 2.0 * (known_db @ probe)
+    return np.sqrt(np.maximum(sq_dists, 0.0))
+
+def _fused_best_match(db_i8, scales, sq_norms, probe_i8, probe_scale, probe_sq_norm):
+    """Single pass over the database: dot product, distance and running argmin."""
+    # Seeded from row 0 rather than infinity: fastmath assumes no infs, so a
+    # comparison against np.inf could be folded away.
+    if db_i8.shape[0] == 0:
+        return -1, 0.0
+    best_idx = -1
+    best_sq = 0.0
+    for i in range(db_i8.shape[0]):
+        acc = 0
+        for j in range(db_i8.shape[1]):
+            acc += np.int32(db_i8[i, j]) * np.int32(probe_i8[j])
+        sq = sq_norms[i] + probe_sq_norm - 2.0 * acc / (scales[i] * probe_scale)
+        if i == 0 or sq < best_sq:
+            best_sq = sq
+            best_idx = i
+    return best_idx, best_sq
+
+if njit is not None:
+    _fused_best_match = njit(fastmath=True, cache=True)(_fused_best_match)
+
+def best_match(encoding):
+    """Returns (index, distance) of the closest known encoding, or (-1, inf) if there are none."""
+    if ann_index is not None:
+        labels, sq_dists = ann_index.knn_query(np.asarray(encoding, dtype=np.float32), k=1)
+        return int(labels[0, 0]), sqrt(max(float(sq_dists[0, 0]), 0.0))
+    if njit is None:
+        faceDis = face_distances(encoding)
+        if len(faceDis) == 0:
+            return -1, float('inf')
+        matchIndex = int(np.argmin(faceDis))
+        return matchIndex, float(faceDis[matchIndex])
+    probe = np.asarray(encoding, dtype=np.float32)
+    probe_i8, probe_scale = quantize_int8(probe)
+    matchIndex, sq_dist = _fused_best_match(known_db_i8, known_scales, known_sq_norms,
+                                            probe_i8[0], probe_scale[0], probe.dot(probe))
+    if matchIndex < 0:
+        return -1, float('inf')
+    return matchIndex, sqrt(max(sq_dist, 0.0))
+
+def grab_frames(cap, frames, stop_event):
+    """Reads webcam frames in the background, keeping only the latest one in `frames`."""
+    while not stop_event.is_set():
+        success, frame = cap.read()
+        # Drop a frame the main loop has not picked up yet; it is stale now.
+        try:
+            frames.get_nowait()
+        except queue.Empty:
+            pass
+        frames.put(frame if success else None)
+        if not success:
+            break
+
+def create_tracker():
+    """Creates a KCF tracker, which lives under cv2.legacy in newer OpenCV builds."""
+    if hasattr(cv2, 'TrackerKCF_create'):
+        return cv2.TrackerKCF_create()
+    return cv2.legacy.TrackerKCF_create()
+
+def to_tracker_bbox(face_location):
+    """Converts a face_recognition (top, right, bottom, left) box to OpenCV (x, y, w, h)."""
+    top, right, bottom, left = face_location
+    return (left, top, right - left, bottom - top)
+
+def from_tracker_bbox(bbox):
+    """Converts an OpenCV (x, y, w, h) box back to (top, right, bottom, left)."""
+    x, y, w, h = (int(v) for v in bbox)
+    return (y, x + w, y + h, x)
+
+def make_challenge_check(challenge, initial_state):
+    """Precomputes a challenge as (sign, index, threshold, reference) for the per-frame check."""
+    if challenge == "Turn Head Left":
+        return (-1.0, NOSE_IDX, HEAD_TURN_THRESHOLD, initial_state[NOSE_IDX])
+    if challenge == "Turn Head Right":
+        return (1.0, NOSE_IDX, HEAD_TURN_THRESHOLD, initial_state[NOSE_IDX])
+    # Smile is an absolute threshold, expressed relative to the initial width
+    return (1.0, MOUTH_IDX, SMILE_ABSOLUTE_THRESHOLD - initial_state[MOUTH_IDX], initial_state[MOUTH_IDX])
+
 def get_face_state(landmarks):
-    """Calculates key metrics of a face for challenge detection."""
-    state = {}
-    
+    """Calculates key metrics of a face for challenge detection, indexed by NOSE_IDX/MOUTH_IDX."""
+    # Convert each region once so the math below works on whole points
+    left_eye = np.asarray(landmarks['left_eye'], dtype=np.float32)
+    right_eye = np.asarray(landmarks['right_eye'], dtype=np.float32)
+    nose_tip = np.asarray(landmarks['nose_tip'][0], dtype=np.float32)
+    chin = np.asarray(landmarks['chin'][8], dtype=np.float32)
+    top_lip = np.asarray(landmarks['top_lip'], dtype=np.float32)
+
     # Nose position for head turn detection
-    nose_tip = landmarks['nose_tip'][0]
-    chin = landmarks['chin'][8]
-    face_center_x = (landmarks['left_eye'][0][0] + landmarks['right_eye'][3][0]) / 2
-    state['relative_nose_x'] = (nose_tip[0] - face_center_x) / (chin[0] - face_center_x + 1e-6)
+    face_center_x = (left_eye[0, 0] + right_eye[3, 0]) / 2
+    rel_nose_x = (nose_tip[0] - face_center_x) / (chin[0] - face_center_x + 1e-6)
 
     # Mouth width for smile detection
-    mouth_left = landmarks['top_lip'][0]
-    mouth_right = landmarks['top_lip'][6]
-    mouth_width = dist.euclidean(mouth_left, mouth_right)
+    mouth_width = np.linalg.norm(top_lip[0] - top_lip[6])
     
     # Normalize by face width (distance between eyes) for consistency
-    left_eye_outer = landmarks['left_eye'][0]
-    right_eye_outer = landmarks['right_eye'][3]
-    face_width = dist.euclidean(left_eye_outer, right_eye_outer)
-    state['relative_mouth_width'] = mouth_width / face_width
+    face_width = np.linalg.norm(left_eye[0] - right_eye[3])
+    rel_mouth = mouth_width / face_width
     
-    return state
+    return np.array([rel_nose_x, rel_mouth], dtype=np.float32)
 
 # ====================================================================
 # 3. LOAD KNOWN FACES (OPTIMIZED)
 # ====================================================================
 
-classNames = []
-known_face_encodings = []
+# The scan below runs in worker processes, which re-import this module, so the
+# script body must only run when executed directly.
+if __name__ == '__main__':
+    classNames = []
 
-try:
-    with open(ENCODINGS_FILE, 'rb') as f:
-        known_face_encodings, classNames = pickle.load(f)
-    print("Loaded encodings from file.")
-except FileNotFoundError:
-    print("Encodings file not found. Computing from images...")
-    student_folders = os.listdir(PATH)
-    for student_name in student_folders:
-        student_path = os.path.join(PATH, student_name)
-        if not os.path.isdir(student_path): continue
-        for img_file in os.listdir(student_path):
-            image_path = os.path.join(student_path, img_file)
-            img = cv2.imread(image_path)
-            if img is None: continue
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            try:
-                encode = face_recognition.face_encodings(img_rgb)[0]
-                known_face_encodings.append(encode)
-                classNames.append(student_name)
-            except IndexError:
-                print(f"Warning: No face found in {student_name}/{img_file}. Skipping.")
-    with open(ENCODINGS_FILE, 'wb') as f:
-        pickle.dump((known_face_encodings, classNames), f)
-    print("Saved new encodings to file.")
-print(f'Found {len(known_face_encodings)} known faces. Encoding complete.')
+    try:
+        # Memory-mapped so startup is O(1) I/O and the pages stay in the page cache.
+        known_db = np.load(ENCODINGS_FILE, mmap_mode='r')
+        with open(CLASS_NAMES_FILE) as f:
+            classNames = json.load(f)
+        print("Loaded encodings from file.")
+    except FileNotFoundError:
+        print("Encodings file not found. Computing from images...")
+        student_dirs = [os.path.join(PATH, d) for d in os.listdir(PATH)]
+        student_dirs = [d for d in student_dirs if os.path.isdir(d)]
+        if dlib.DLIB_USE_CUDA:
+            # One process owns the GPU and batches folders together, a bounded
+            # group at a time; per-process models would each load onto the
+            # same device.
+            results = encode_students_in_groups(student_dirs)
+        else:
+            # Each student's images are encoded in a separate worker process,
+            # since the CNN embedding is CPU-bound and runs on one core per call.
+            with ProcessPoolExecutor() as ex:
+                results = list(ex.map(encode_student, student_dirs))
+        # Stored as one contiguous (N, 128) array so matching is a single
+        # matrix-vector product instead of a Python-level loop per call.
+        known_db = np.empty((sum(len(enc) for _, enc in results), 128), dtype=np.float32)
+        row = 0
+        for student_name, encodings in results:
+            known_db[row:row + len(encodings)] = encodings
+            classNames.extend([student_name] * len(encodings))
+            row += len(encodings)
+        np.save(ENCODINGS_FILE, known_db)
+        with open(CLASS_NAMES_FILE, 'w') as f:
+            json.dump(classNames, f)
+        print("Saved new encodings to file.")
+    print(f'Found {len(known_db)} known faces. Encoding complete.')
 
-# ====================================================================
-# 4. INITIALIZE WEBCAM AND MAIN LOOP
-# ====================================================================
+    known_sq_norms = np.einsum('ij,ij->i', known_db, known_db)
 
-cap = cv2.VideoCapture(0)
-if not cap.isOpened():
-    print("Error: Could not open video stream.")
-    exit()
-
-while True:
-    success, img = cap.read()
-    if not success:
-        print("Failed to grab frame")
-        break
-
-    imgS = cv2.resize(img, (0, 0), None, 0.25, 0.25)
-    imgS = cv2.cvtColor(imgS, cv2.COLOR_BGR2RGB)
-
-    faces_in_frame = face_recognition.face_locations(imgS)
-    face_landmarks_list = face_recognition.face_landmarks(imgS, faces_in_frame)
-
-    if not faces_in_frame:
-        liveness_approved = False
-        challenge_sequence = []
-        current_challenge_index = -1
-        challenge_start_time = None
-
-    # --- LIVENESS CHALLENGE LOGIC ---
-    if not liveness_approved:
-        if faces_in_frame and not challenge_sequence:
-            challenge_sequence = random.sample(CHALLENGES, 2)
-            current_challenge_index = 0
-            challenge_start_time = datetime.now()
-            initial_face_state = get_face_state(face_landmarks_list[0])
-            print(f"Starting challenges: {challenge_sequence}")
-
-        if challenge_sequence:
-            current_challenge = challenge_sequence[current_challenge_index]
-            cv2.putText(img, f"Challenge: {current_challenge}", (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 2)
-
-            elapsed_time = (datetime.now() - challenge_start_time).total_seconds()
-            
-            # --- START OF CORRECTED BLOCK ---
-            # All the logic for checking is now INSIDE this if statement
-            if elapsed_time > CHALLENGE_GRACE_PERIOD:
-                current_face_state = get_face_state(face_landmarks_list[0])
-                challenge_passed = False
-                condition_met = False
-
-                if current_challenge == "Turn Head Left":
-                    if current_face_state['relative_nose_x'] < initial_face_state['relative_nose_x'] - HEAD_TURN_THRESHOLD:
-                        condition_met = True
-                elif current_challenge == "Turn Head Right":
-                    if current_face_state['relative_nose_x'] > initial_face_state['relative_nose_x'] + HEAD_TURN_THRESHOLD:
-                        condition_met = True
-                elif current_challenge == "Smile":
-                    if current_face_state['relative_mouth_width'] > SMILE_ABSOLUTE_THRESHOLD:
-                        condition_met = True
-                
-                if condition_met:
-                    challenge_confirmation_counter += 1
-                else:
-                    challenge_confirmation_counter = 0
+    # A linear scan is exact and fast enough for a few hundred students; past
+    # that, switch to an HNSW graph for sub-linear lookups. hnswlib's 'l2'
+    # space reports squared distances.
+    ann_index = None
+    if hnswlib is not None and len(known_db) >= ANN_MIN_FACES:
+        ann_index = hnswlib.Index(space='l2', dim=128)
+        ann_index.init_index(max_elements=len(known_db), ef_construction=200, M=16)
+        ann_index.add_items(known_db, np.arange(len(known_db)))
+        ann_index.set_ef(50)
+
+    # The int8 copy is only read by the compiled linear-scan kernel
+    known_db_i8 = known_scales = None
+    if njit is not None and ann_index is None:
+        known_db_i8, known_scales = quantize_int8(known_db)
+
+    # ====================================================================
+    # 4. INITIALIZE WEBCAM AND MAIN LOOP
+    # ====================================================================
+
+    cap = cv2.VideoCapture(0)
+    if not cap.isOpened():
+        print("Error: Could not open video stream.")
+        exit()
+    # Ask the camera for compressed frames at the size we actually process, so
+    # it does the scaling and the USB link carries far fewer bytes.
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
+
+    # Held open for the whole session rather than reopened on every mark
+    attendance_file = open_attendance_file()
+
+    frame_idx = 0
+    tracker = None
+    imgS_bgr = None
+    imgS = None
+
+    # Capture runs on its own thread so the camera keeps up while dlib works;
+    # dlib and OpenCV release the GIL inside their C++ routines.
+    frames = queue.Queue(maxsize=1)
+    stop_event = threading.Event()
+    grabber = threading.Thread(target=grab_frames, args=(cap, frames, stop_event), daemon=True)
+    grabber.start()
+
+    while True:
+        img = frames.get()
+        if img is None:
+            print("Failed to grab frame")
+            break
+        # Monotonic seconds, read once per frame, for all challenge timing
+        frame_time = time.monotonic()
 
-                if challenge_confirmation_counter >= CHALLENGE_CONFIRMATION_FRAMES:
-                    challenge_passed = True
+        # Downscale and convert into buffers allocated once, rather than two new
+        # frame-sized arrays per iteration. INTER_AREA is the cheaper and more
+        # accurate choice when shrinking.
+        # The factor follows the delivered frame, since cameras may ignore the
+        # requested size; without upsampling, dlib's 80x80 HOG window needs
+        # around DETECT_HEIGHT rows to find a face at kiosk distance.
+        frame_scale = max(1, img.shape[0] // DETECT_HEIGHT)
+        small_h, small_w = img.shape[0] // frame_scale, img.shape[1] // frame_scale
+        if imgS is None or imgS.shape[:2] != (small_h, small_w):
+            imgS_bgr = np.empty((small_h, small_w, 3), dtype=np.uint8)
+            imgS = np.empty_like(imgS_bgr)
+            tracker = None  # Its box is in the old frame's coordinates
+        cv2.resize(img, (small_w, small_h), dst=imgS_bgr, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(imgS_bgr, cv2.COLOR_BGR2RGB, dst=imgS)
+
+        # The detector dominates frame time, so only run it every DETECT_EVERY
+        # frames (or while nothing is being tracked) and follow the face with the
+        # much cheaper correlation tracker in between.
+        faces_in_frame = []
+        if tracker is not None and frame_idx % DETECT_EVERY != 0:
+            ok, bbox = tracker.update(imgS)
+            if ok:
+                faces_in_frame = [from_tracker_bbox(bbox)]
+            else:
+                # KCF often drops the face mid head-turn; re-detect in this same
+                # frame so a lost track alone does not reset the challenge.
+                tracker = None
+        if tracker is None or frame_idx % DETECT_EVERY == 0:
+            faces_in_frame = face_recognition.face_locations(imgS, number_of_times_to_upsample=DETECT_UPSAMPLE, model='hog')
+            tracker = None
+            if faces_in_frame:
+                tracker = create_tracker()
+                tracker.init(imgS, to_tracker_bbox(faces_in_frame[0]))
+        frame_idx += 1
+
+        # Landmarks only feed the liveness challenge, so skip the shape
+        # predictor once the face has been approved.
+        face_landmarks_list = face_recognition.face_landmarks(imgS, faces_in_frame) if (not liveness_approved and faces_in_frame) else None
+
+        if not faces_in_frame:
+            liveness_approved = False
+            challenge_sequence = []
+            current_challenge_index = -1
+            challenge_start_time = None
+            recognized_name = None
+            next_recognition_time = 0.0
+
+        # --- LIVENESS CHALLENGE LOGIC ---
+        if not liveness_approved:
+            if faces_in_frame and not challenge_sequence:
+                challenge_sequence = random.sample(CHALLENGES, 2)
+                current_challenge_index = 0
+                challenge_start_time = frame_time
+                initial_face_state = get_face_state(face_landmarks_list[0])
+                challenge_check = make_challenge_check(challenge_sequence[0], initial_face_state)
+                print(f"Starting challenges: {challenge_sequence}")
+
+            if challenge_sequence:
+                current_challenge = challenge_sequence[current_challenge_index]
+                cv2.putText(img, f"Challenge: {current_challenge}", (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 2)
+
+                elapsed_time = frame_time - challenge_start_time
             
-                if challenge_passed:
-                    print(f"Passed: {current_challenge}")
-                    current_challenge_index += 1
-                    if current_challenge_index >= len(challenge_sequence):
-                        liveness_approved = True
-                        print("Liveness Approved!")
+                # --- START OF CORRECTED BLOCK ---
+                # All the logic for checking is now INSIDE this if statement
+                if elapsed_time > CHALLENGE_GRACE_PERIOD:
+                    current_face_state = get_face_state(face_landmarks_list[0])
+                    challenge_passed = False
+                    sign, state_idx, threshold, reference = challenge_check
+                    condition_met = sign * (current_face_state[state_idx] - reference) > threshold
+                
+                    if condition_met:
+                        challenge_confirmation_counter += 1
                     else:
-                        challenge_start_time = datetime.now()
-                        initial_face_state = get_face_state(face_landmarks_list[0])
                         challenge_confirmation_counter = 0
 
-            # This timeout check is now an elif
-            elif elapsed_time > CHALLENGE_TIMEOUT:
-                print("Challenge timed out. Resetting.")
-                challenge_sequence = []
-            # --- END OF CORRECTED BLOCK ---
-
-    # --- RECOGNITION LOGIC ---
-    else:
-        cv2.putText(img, "Liveness Approved", (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 2)
-        encodes_in_frame = face_recognition.face_encodings(imgS, faces_in_frame)
-        for encodeFace, faceLoc in zip(encodes_in_frame, faces_in_frame):
-            matches = face_recognition.compare_faces(known_face_encodings, encodeFace, tolerance=0.50)
-            faceDis = face_recognition.face_distance(known_face_encodings, encodeFace)
-            if len(faceDis) > 0:
-                matchIndex = np.argmin(faceDis)
-                name = "Disapproved"
-                color = (0, 0, 255)
-                if matches[matchIndex]:
-                    name = classNames[matchIndex].upper()
-                    color = (0, 255, 0)
-                    mark_attendance(name)
-                y1, x2, y2, x1 = faceLoc
-                y1, x2, y2, x1 = y1 * 4, x2 * 4, y2 * 4, x1 * 4
-                cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
-                cv2.rectangle(img, (x1, y2 - 35), (x2, y2), color, cv2.FILLED)
-                cv2.putText(img, name, (x1 + 6, y2 - 6), cv2.FONT_HERSHEY_COMPLEX, 1, (255, 255, 255), 2)
-
-    cv2.imshow('Webcam', img)
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
+                    if challenge_confirmation_counter >= CHALLENGE_CONFIRMATION_FRAMES:
+                        challenge_passed = True
+            
+                    if challenge_passed:
+                        print(f"Passed: {current_challenge}")
+                        current_challenge_index += 1
+                        if current_challenge_index >= len(challenge_sequence):
+                            liveness_approved = True
+                            print("Liveness Approved!")
+                        else:
+                            challenge_start_time = frame_time
+                            initial_face_state = get_face_state(face_landmarks_list[0])
+                            challenge_check = make_challenge_check(challenge_sequence[current_challenge_index], initial_face_state)
+                            challenge_confirmation_counter = 0
 
-# ====================================================================
-# 5. CLEANUP
-# ====================================================================
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+                # This timeout check is now an elif
+                elif elapsed_time > CHALLENGE_TIMEOUT:
+                    print("Challenge timed out. Resetting.")
+                    challenge_sequence = []
+                # --- END OF CORRECTED BLOCK ---
+
+        # --- RECOGNITION LOGIC ---
+        else:
+            cv2.putText(img, "Liveness Approved", (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 2)
+            # Identity cannot change while the face stays in view, so once a
+            # match succeeds it is reused for the rest of the session. A failed
+            # match is retried, since the first embedding is often taken while
+            # the student is still finishing a head turn or smile.
+            if recognized_name is None and frame_time >= next_recognition_time:
+                encodeFace = face_recognition.face_encodings(imgS, faces_in_frame[:1])[0]
+                matchIndex, matchDistance = best_match(encodeFace)
+                if matchIndex >= 0 and matchDistance <= MATCH_TOLERANCE:
+                    recognized_name = classNames[matchIndex].upper()
+                    mark_attendance(recognized_name)
+                else:
+                    next_recognition_time = frame_time + RECOGNITION_RETRY_INTERVAL
+            label = recognized_name if recognized_name is not None else "Disapproved"
+            color = (0, 255, 0) if recognized_name is not None else (0, 0, 255)
+            y1, x2, y2, x1 = faces_in_frame[0]
+            y1, x2, y2, x1 = y1 * frame_scale, x2 * frame_scale, y2 * frame_scale, x1 * frame_scale
+            cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+            cv2.rectangle(img, (x1, y2 - 35), (x2, y2), color, cv2.FILLED)
+            cv2.putText(img, label, (x1 + 6, y2 - 6), cv2.FONT_HERSHEY_COMPLEX, 1, (255, 255, 255), 2)
+
+        cv2.imshow('Webcam', img)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    # ====================================================================
+    # 5. CLEANUP
+    # ====================================================================
+    stop_event.set()
+    grabber.join()
+    cap.release()
+    attendance_file.close()
+    cv2.destroyAllWindows()
\ No newline at end of file